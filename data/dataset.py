@@ -82,5 +82,26 @@ class PretrainDataset(InMemoryDataset):
         data.eigenvector_centrality = data.eigenvector_centrality.unsqueeze(1)
         data.train_mask, data.val_mask, data.test_mask = self.dataset_split(data)
         torch.save(data, self.processed_paths[0])
+        for split in ("train", "val", "test"):
+            self.save_split_index(data, split)
+
+    def split_path(self, split):
+        return osp.join(self.processed_dir, "{:s}_{:s}_idx.pt".format(self.name, split))
+
+    def save_split_index(self, data, split):
+        index = getattr(data, split + "_mask").nonzero(as_tuple=False).view(-1)
+        torch.save(index, self.split_path(split))
+        return index
+
+    def split_index(self, split):
+        """
+        node indices of a split, cached next to the processed graph
+        :param split: train, val or test
+        :return: index tensor [N]
+        """
+        path = self.split_path(split)
+        if osp.exists(path):
+            return torch.load(path)
+        return self.save_split_index(self[0], split)
 
 
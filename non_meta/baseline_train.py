@@ -1,17 +1,18 @@
+import atexit
 import datetime
 import gc
 import json
 import logging
 import os
+import queue
 import sys
+import threading
 import time
 import warnings
 
 import numpy as np
 import torch
-import torch.nn.functional as F
 from torch import optim
-from torch.nn.functional import huber_loss
 from torch_geometric.loader import DataLoader, NeighborLoader
 from torch.utils.tensorboard import SummaryWriter
 from data.data_load import importance_graph_load, counting_graph_load
@@ -19,7 +20,8 @@ from data.dataset import PretrainDataset
 from model.baselinemodel import BaseGNN
 
 warnings.filterwarnings("ignore")
-torch.autograd.set_detect_anomaly(True)
+if os.environ.get("TORCH_ANOMALY"):
+    torch.autograd.set_detect_anomaly(True)
 INF = float("inf")
 
 train_config = {
@@ -50,6 +52,8 @@ train_config = {
     "attr_ratio": 0.5,
     "decay_patience": 20,
     "max_grad_norm": 8,
+    "amp": True,  # bf16 autocast for the forward pass on CUDA
+    "compile": True,  # torch.compile the model on CUDA
     "model": "GAT",  # Graphormer
     "emb_dim": 32,
     "activation_function": "relu",  # sigmoid, softmax, tanh, relu, leaky_relu, prelu, gelu
@@ -81,6 +85,40 @@ train_config = {
 }
 
 
+class AsyncScalarWriter:
+    """
+    hand scalars to a background thread so the protobuf encoding in add_scalar stays off
+    the training loop (SummaryWriter already writes events to disk on its own thread)
+    :param writer: the wrapped SummaryWriter
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.scalars = queue.Queue()
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            item = self.scalars.get()
+            if item is None:
+                self.writer.flush()
+                return
+            try:
+                self.writer.add_scalar(*item)
+            except Exception:
+                # keep draining the queue, a dead consumer would let it grow for the whole run
+                logging.getLogger().exception("failed to write scalar %s", item[0])
+
+    def add_scalar(self, tag, value, step):
+        self.scalars.put((tag, value, step))
+
+    def close(self):
+        self.scalars.put(None)
+        self.thread.join()
+        self.writer.close()
+
+
 def train(
         model,
         optimizer,
@@ -94,33 +132,16 @@ def train(
         writer=None,
         bottleneck=False,
 ):
-    global bp_crit, reg_crit
     epoch_step = len(data_loader)
     total_step = config["epochs"] * epoch_step
     total_var_loss = 0
     total_reg_loss = 0
     total_bp_loss = 0
     total_cnt = 1e-6
-    if config["reg_loss"] == "MAE":
-        reg_crit = lambda pred, target: F.l1_loss(F.relu(pred), target)
-    elif config["reg_loss"] == "MSE":
-        reg_crit = lambda pred, target: F.mse_loss(F.relu(pred), target)
-    elif config["reg_loss"] == "SMSE":
-        reg_crit = lambda pred, target: F.smooth_l1_loss(pred, target)
-    elif config["reg_loss"] == "HUBER":
-        reg_crit = lambda pred, target: F.huber_loss(pred, target, delta=0.1)
-    if config["bp_loss"] == "MAE":
-        bp_crit = lambda pred, target: F.l1_loss(F.leaky_relu(pred), target)
-    elif config["bp_loss"] == "MSE":
-        bp_crit = lambda pred, target: F.mse_loss(pred, target)
-    elif config["bp_loss"] == "SMSE":
-        bp_crit = lambda pred, target: F.smooth_l1_loss(pred, target)
-    elif config["bp_loss"] == "HUBER":
-        bp_crit = lambda pred, target: F.huber_loss(pred, target, delta=0.1)
     # data preparation
     # config['init_pe_dim'] = graph.edge_attr.size(1)
     if bottleneck:
-        model.load_state_dict(
+        getattr(model, "_orig_mod", model).load_state_dict(
             torch.load(
                 os.path.join(
                     save_model_dir,
@@ -133,56 +154,61 @@ def train(
     model.to(device)
 
     model.train()
-    total_time = 0
+    use_amp = config["amp"] and device.type == "cuda"
+    loss_accum = torch.zeros((), device=device)
+    accum_cnt = 0
+    s = time.time()
     for i, batch in enumerate(data_loader):
-        batch = batch.to(device)
-        batch.x = batch.x.to(torch.float32)
-        s = time.time()
+        batch.x = batch.x.to(device=device, dtype=torch.float32, non_blocking=True)
+        batch = batch.to(device, non_blocking=True)
         if config['model'] == "Graphormer":
-            pred, importance_loss = model(batch)
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=use_amp):
+                pred, importance_loss = model(batch)
             total_loss_per_step = importance_loss
         else:
-            importance_loss = model(batch)
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=use_amp):
+                importance_loss = model(batch)
             total_loss_per_step = importance_loss
             total_loss_per_step.backward()
-            if (i + 1) % config['update_every'] == 0:
+            if (i + 1) % config['update_every'] == 0 or i == epoch_step - 1:
+                if config["max_grad_norm"] > 0:
+                    torch.nn.utils.clip_grad_norm_(
+                        model.parameters(), config["max_grad_norm"], foreach=True
+                    )
                 optimizer.step()
-                optimizer.zero_grad()
-        bp_loss_item = total_loss_per_step.item()
-        total_bp_loss += bp_loss_item
+                optimizer.zero_grad(set_to_none=True)
+        # accumulate on device, only sync with the host when logging
+        loss_accum += total_loss_per_step.detach()
+        accum_cnt += 1
 
-        if writer:
-            writer.add_scalar(
-                "%s/BP-%s" % (data_type, config["bp_loss"]),
-                bp_loss_item,
-                epoch * epoch_step + i,
-            )
-
-        if logger and (
-                (i / config["batch_size"]) % config["print_every"] == 0
-                or i == epoch_step - 1
-        ):
-            logger.info(
-                "epoch: {:0>3d}/{:0>3d}\tdata_type: {:<5s}\tbatch: {:0>5d}/{:0>5d}\tbp loss: {:.5f}\t".format(
-                    int(epoch),
-                    int(config["epochs"]),
-                    data_type,
-                    int(i / config["batch_size"]),
-                    int(epoch_step / config["batch_size"]),
-                    float(bp_loss_item),
+        if (i / config["batch_size"]) % config["print_every"] == 0 or i == epoch_step - 1:
+            bp_loss_sum = loss_accum.item()
+            total_bp_loss += bp_loss_sum
+            bp_loss_item = bp_loss_sum / accum_cnt
+            loss_accum.zero_()
+            accum_cnt = 0
+            if writer:
+                writer.add_scalar(
+                    "%s/BP-%s" % (data_type, config["bp_loss"]),
+                    bp_loss_item,
+                    epoch * epoch_step + i,
                 )
-            )
-
-        if (i + 1) % config["batch_size"] == 0 or i == epoch_step - 1:
-            if config["max_grad_norm"] > 0:
-                torch.nn.utils.clip_grad_norm_(
-                    model.parameters(), config["max_grad_norm"]
+            if logger:
+                logger.info(
+                    "epoch: {:0>3d}/{:0>3d}\tdata_type: {:<5s}\tbatch: {:0>5d}/{:0>5d}\tbp loss: {:.5f}\t".format(
+                        int(epoch),
+                        int(config["epochs"]),
+                        data_type,
+                        int(i / config["batch_size"]),
+                        int(epoch_step / config["batch_size"]),
+                        float(bp_loss_item),
+                    )
                 )
-            optimizer.step()
-            optimizer.zero_grad()
-        e = time.time()
-        total_time += e - s
         total_cnt += 1
+    # steps are not synced individually, so time the whole epoch like evaluate()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    total_time = time.time() - s
     mean_bp_loss = total_bp_loss / total_cnt
     if writer:
         writer.add_scalar(
@@ -199,44 +225,46 @@ def train(
     return mean_bp_loss, total_time
 
 
-def evaluate(model, data_type, data_loader, config, logger=None, writer=None):
+def evaluate(model, data_type, data_loader, device, config, logger=None, writer=None):
     epoch_step = len(data_loader)
     total_step = config["epochs"] * epoch_step
     total_var_loss = 0
     total_reg_loss = 0
-    total_bp_loss = 0
+    total_bp_loss = torch.zeros((), device=device)
     total_cnt = 1e-6
 
     evaluate_results = {"mean": {"importance": list()},
                         "error": {"importance_loss": list()},
                         "time": {"avg": list(), "total": 0.0}}
     model.eval()
-    model = model.to("cpu")
-    total_time = 0
-    with torch.no_grad():
+    model = model.to(device)
+    use_amp = config["amp"] and device.type == "cuda"
+    imp_chunks, loss_chunks = list(), list()
+    with torch.inference_mode():
+        st = time.time()
         for batch_id, batch in enumerate(data_loader):
-            batch.x = batch.x.to(torch.float32)
-            st = time.time()
-            importance = batch.degree_centrality
-            evaluate_results["mean"]["importance"].extend(importance.view(-1).tolist())
-            if config['model'] == "Graphormer":
-                pred, importance_loss = model(batch)
-                bp_loss = importance_loss
-            else:
-                importance_loss = model(batch)
-                bp_loss = importance_loss
-            et = time.time()
-            evaluate_results["time"]["total"] += et - st
-            avg_t = et - st
-
-            evaluate_results["time"]["avg"].extend([avg_t])
-            bp_loss_item = bp_loss.mean().item()
-            total_bp_loss += bp_loss_item
-            evaluate_results["error"]["importance_loss"].extend(importance_loss.view(-1).tolist())
-            et = time.time()
-            total_time += et - st
+            # labels are only reported, keep them on the host
+            imp_chunks.append(batch.degree_centrality.view(-1))
+            batch.x = batch.x.to(device=device, dtype=torch.float32, non_blocking=True)
+            batch = batch.to(device, non_blocking=True)
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=use_amp):
+                if config['model'] == "Graphormer":
+                    pred, importance_loss = model(batch)
+                else:
+                    importance_loss = model(batch)
+            bp_loss = importance_loss
+            total_bp_loss += bp_loss.mean()
+            loss_chunks.append(importance_loss.view(-1))
             total_cnt += 1
-        mean_bp_loss = total_bp_loss / total_cnt
+        # batches are not synced individually, so only the whole pass can be timed
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        total_time = time.time() - st
+        evaluate_results["time"]["total"] = total_time
+        evaluate_results["time"]["avg"].append(total_time / total_cnt)
+        mean_bp_loss = total_bp_loss.item() / total_cnt
+        evaluate_results["mean"]["importance"] = torch.cat(imp_chunks).numpy().tolist()
+        evaluate_results["error"]["importance_loss"] = torch.cat(loss_chunks).tolist()
         if logger and batch_id == epoch_step - 1 and config["test_only"] is False:
             logger.info(
                 "epoch: {:0>3d}/{:0>3d}\tdata_type: {:<5s}\tbatch: {:d}/{:d}\tbp loss: {:.4f}\t".format(
@@ -245,7 +273,7 @@ def evaluate(model, data_type, data_loader, config, logger=None, writer=None):
                     (data_type),
                     int(batch_id),
                     int(epoch_step),
-                    float(bp_loss_item),
+                    float(bp_loss.mean()),
                 )
             )
             # float(var), float(pred_var[0].item())))
@@ -264,7 +292,8 @@ def evaluate(model, data_type, data_loader, config, logger=None, writer=None):
 
 def model_test(save_model_dir, test_loaders, config, logger, writer):
     total_test_time = 0
-    model.load_state_dict(
+    # checkpoints hold the uncompiled module's keys
+    getattr(model, "_orig_mod", model).load_state_dict(
         torch.load(
             os.path.join(
                 save_model_dir,
@@ -277,6 +306,7 @@ def model_test(save_model_dir, test_loaders, config, logger, writer):
         model=model,
         data_type="test",
         data_loader=test_loaders,
+        device=device,
         config=config,
         logger=logger,
         writer=writer,
@@ -307,6 +337,7 @@ def model_test(save_model_dir, test_loaders, config, logger, writer):
 
 if __name__ == "__main__":
     torch.manual_seed(0)
+    torch.cuda.manual_seed_all(0)
     np.random.seed(0)
 
     for i in range(1, len(sys.argv), 2):
@@ -364,17 +395,22 @@ if __name__ == "__main__":
     if train_config['dataset'] == "flixster":
         data = PretrainDataset(name=train_config['dataset'], filepath=train_config['dataset'])[0][0]
     else:
-        data = PretrainDataset(name=train_config['dataset'], filepath=train_config['dataset'])[0]
+        dataset = PretrainDataset(name=train_config['dataset'], filepath=train_config['dataset'])
+        data = dataset[0]
         kwargs = dict(
             data=data,
             num_neighbors=[10, 10] * 2,
             batch_size=train_config["batch_size"],
-            num_workers=8,
-            pin_memory=True
+            num_workers=train_config["num_workers"],
+            pin_memory=True,
+            pin_memory_device=str(device) if device.type == "cuda" else "",
         )
-        train_idx = data.train_mask.nonzero(as_tuple=False).view(-1)
-        val_idx = data.val_mask.nonzero(as_tuple=False).view(-1)
-        test_idx = data.val_mask.nonzero(as_tuple=False).view(-1)
+        if kwargs["num_workers"] > 0:
+            # keep sampler workers alive across epochs and sample ahead of the GPU
+            kwargs.update(persistent_workers=True, prefetch_factor=4)
+        train_idx = dataset.split_index("train")
+        val_idx = dataset.split_index("val")
+        test_idx = dataset.split_index("test")
         train_loader = NeighborLoader(
             input_nodes=train_idx,
             shuffle=True,
@@ -408,7 +444,10 @@ if __name__ == "__main__":
         raise NotImplementedError(
             "Currently, the %s model is not supported" % (train_config["model"])
         )
-    # model = torch.compile(model)
+    model = model.to(device)
+    if train_config["compile"] and device.type == "cuda":
+        # NeighborLoader yields a different number of nodes per batch, which rules out CUDA graphs
+        model = torch.compile(model, mode="default", dynamic=True, fullgraph=False)
     logger.info(model)
     logger.info(
         "num of parameters: %d"
@@ -416,20 +455,24 @@ if __name__ == "__main__":
     )
 
     # optimizer and losses
-    writer = SummaryWriter()
+    writer = AsyncScalarWriter(SummaryWriter())
+    atexit.register(writer.close)
     optimizer = torch.optim.Adam(
         model.parameters(),
         lr=train_config["lr"],
         weight_decay=train_config["weight_decay"],
         eps=1e-6,
+        fused=device.type == "cuda",
     )
-    optimizer.zero_grad()
-    scheduler = torch.optim.lr_scheduler.ExponentialLR(
-        optimizer, gamma=train_config["decay_factor"]
+    optimizer.zero_grad(set_to_none=True)
+    scheduler = torch.optim.lr_scheduler.StepLR(
+        optimizer, step_size=train_config["decay_patience"], gamma=train_config["decay_factor"]
     )
     best_bp_losses = INF
     best_bp_epochs = {"train": -1, "val": -1, "test": -1}
     torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     total_train_time = 0
     total_dev_time = 0
     total_test_time = 0
@@ -459,13 +502,13 @@ if __name__ == "__main__":
             bottleneck=False,
         )
         total_train_time += _time
-        if scheduler and (epoch + 1) % train_config["decay_patience"] == 0:
-            scheduler.step()
-            # torch.save(model.state_dict(), os.path.join(save_model_dir, 'epoch%d.pt' % (epoch)))
+        scheduler.step()
+        # torch.save(model.state_dict(), os.path.join(save_model_dir, 'epoch%d.pt' % (epoch)))
         mean_bp_loss, evaluate_results, total_time = evaluate(
             model=model,
             data_type="val",
             data_loader=val_loader,
+            device=device,
             config=train_config,
             logger=logger,
             writer=writer,
@@ -495,7 +538,7 @@ if __name__ == "__main__":
                 )
             )
             torch.save(
-                model.state_dict(),
+                getattr(model, "_orig_mod", model).state_dict(),
                 os.path.join(
                     save_model_dir,
                     "best_epoch_{:s}.pt".format(train_config["model"]),
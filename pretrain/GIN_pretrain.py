@@ -2,7 +2,7 @@ import torch.nn as nn
 import torch
 from torch_geometric.nn import global_mean_pool
 
-from utils.mask import make_mask
+from utils.mask import make_mask, split_mask
 from pretrain.base import PreTrain
 from model.attention import TransformerRegressor
 import torch.nn.functional as F
@@ -37,14 +37,10 @@ class GraphTrainer(PreTrain):
         )
 
     def importance_loss(self, pred_importance, target_importance):
-        return F.mse_loss(
-            pred_importance.float(), target_importance.float(), reduction="mean"
-        )
+        return F.mse_loss(pred_importance.float(), target_importance.float())
 
     def similarity_loss(self, pred_feat, orig_feat):
-        return F.mse_loss(
-            pred_feat.float(), orig_feat.float(), reduction="mean"
-        )
+        return F.mse_loss(pred_feat.float(), orig_feat.float())
 
     def forward(self, data, use_mask=True):
         x, edge_index, edge_attr, importance, batch = (
@@ -65,13 +61,17 @@ class GraphTrainer(PreTrain):
         importance_loss = self.importance_loss(pred_importance.squeeze(), importance)
 
         if mask is not None:
-            pos_emd_vis = self.pos_decoder(pred[mask])
-            pos_emd_mask = self.pos_decoder(pred[~mask])
+            mask_idx, unmask_idx = split_mask(mask)
+            pred_vis = pred.index_select(0, mask_idx)
+            # decode positions for all nodes in one GEMM, then split
+            pos = self.pos_decoder(pred)
+            pos_emd_vis = pos.index_select(0, mask_idx)
+            pos_emd_mask = pos.index_select(0, unmask_idx)
             num_mask, _ = pos_emd_mask.shape
             mask_token = self.mask_token.expand(num_mask, -1)
             pred_attr = self.mask_regressor(
-                mask_token, pred[mask], pos_emd_mask, pos_emd_vis, mask
+                mask_token, pred_vis, pos_emd_mask, pos_emd_vis, mask
             )
             pred_attr = self.matcher(pred_attr)
-            attr_loss = self.similarity_loss(pred_attr, data.x[~mask])
+            attr_loss = self.similarity_loss(pred_attr, data.x.index_select(0, unmask_idx))
             return importance_loss, attr_loss
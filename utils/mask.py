@@ -1,26 +1,29 @@
-import numpy as np
 import torch
 from torch_geometric.utils import index_to_mask
 
 
-def make_mask(node_index, mask_ratio=0.3, no_aug=False):
+def make_mask(node_index, mask_ratio=0.3, no_aug=False, generator=None):
     """
     mask the selected node to
     :param node_index: the node index of the selected subgraph [N,1]
+    :param generator: optional torch.Generator living on the same device as node_index
     :return: masked index
     """
-    cnt = 0
     N, D = node_index.shape
     if no_aug or mask_ratio == 0:
-        return torch.zeros((N, 1)).bool()
-    num_mask = int(mask_ratio * N)
-    overall_mask = np.ones(N)
-    for i in range(len(overall_mask)):
-        if cnt >= num_mask:
-            continue
-        elif np.random.random() >= 0.5:
-            overall_mask[i] = 0
-            cnt += 1
-    
-    overall_mask = torch.tensor(overall_mask).bool()
-    return overall_mask.to(node_index.device)
+        return torch.zeros((N, 1), dtype=torch.bool, device=node_index.device)
+    # sampled on the device of node_index, False marks a masked node
+    return torch.rand(N, device=node_index.device, generator=generator) >= mask_ratio
+
+
+def split_mask(mask):
+    """
+    split a node mask into the indices of selected and unselected nodes
+    :param mask: bool mask of the subgraph nodes [N] or [N,1]
+    :return: (mask index, unmask index)
+    """
+    mask = mask.view(-1)
+    # one stable sort puts the selected nodes first, so only the count needs a host sync
+    order = torch.argsort((~mask).byte(), stable=True)
+    num_mask = int(mask.sum())
+    return order[:num_mask], order[num_mask:]